@@ -1,57 +1,273 @@
 #!/usr/bin/env python3
 import argparse
-import json
-import subprocess
+import datetime
+import functools
+import hashlib
+import os
 import sys
 import re
+import time
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-def run_aws_command(command):
-    """Run AWS CLI command and return the output as JSON"""
+import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+# Prefer orjson for the large pricing documents, falling back to the standard library.
+# json_loads parses str or bytes, json_dumps serializes to bytes (indented with 2 spaces if indent).
+try:
+    import orjson
+
+    def json_loads(data):
+        return orjson.loads(data)
+
+    def json_dumps(obj, indent=False):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+except ImportError:
+    import json
+
+    def json_loads(data):
+        return json.loads(data)
+
+    def json_dumps(obj, indent=False):
+        return json.dumps(obj, indent=2 if indent else None).encode()
+
+# AWS clients, created once in main() and shared by all worker threads
+ec2 = None
+pricing = None
+
+# Map region to pricing region format
+PRICING_LOCATIONS = {
+    "us-east-1": "US East (N. Virginia)",
+    "us-east-2": "US East (Ohio)",
+    "us-west-1": "US West (N. California)",
+    "us-west-2": "US West (Oregon)",
+    "eu-west-1": "EU (Ireland)",
+    "eu-central-1": "EU (Frankfurt)",
+    "ap-northeast-1": "Asia Pacific (Tokyo)",
+    "ap-southeast-1": "Asia Pacific (Singapore)",
+    "ap-southeast-2": "Asia Pacific (Sydney)",
+    "ap-south-1": "Asia Pacific (Mumbai)",
+    "eu-west-2": "EU (London)",
+    "eu-west-3": "EU (Paris)",
+    "eu-north-1": "EU (Stockholm)",
+    "sa-east-1": "South America (Sao Paulo)",
+    "ca-central-1": "Canada (Central)",
+    "ap-east-1": "Asia Pacific (Hong Kong)",
+    "me-south-1": "Middle East (Bahrain)",
+    "af-south-1": "Africa (Cape Town)",
+    "eu-south-1": "EU (Milan)",
+    # Add more mappings as needed
+}
+
+# Instance size suffix, e.g. ".2xlarge" in "m5.2xlarge"
+SIZE_SUFFIX_RE = re.compile(r'\.\d+.*$')
+
+# Maximum number of instance types per DescribeSpotPriceHistory query
+SPOT_PRICE_BATCH_SIZE = 100
+
+# On-disk cache for slowly changing API responses, disabled with --no-cache
+CACHE_DIR = os.path.expanduser("~/.cache/eks-cost")
+cache_enabled = True
+
+DAY = 24 * 60 * 60
+
+def cached(ttl):
+    """Cache a function's JSON-serializable result on disk for ttl seconds, keyed by its arguments"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            if not cache_enabled:
+                return func(*args)
+            
+            key = json_dumps([func.__name__, *args])
+            path = os.path.join(CACHE_DIR, hashlib.sha256(key).hexdigest() + ".json")
+            try:
+                with open(path, "rb") as f:
+                    entry = json_loads(f.read())
+                if time.time() - entry["timestamp"] < ttl:
+                    return entry["value"]
+            except (OSError, ValueError, KeyError):
+                pass
+            
+            value = func(*args)
+            # Don't cache empty results, they usually mean the request failed
+            if value:
+                try:
+                    os.makedirs(CACHE_DIR, exist_ok=True)
+                    tmp_path = f"{path}.{os.getpid()}.tmp"
+                    with open(tmp_path, "wb") as f:
+                        f.write(json_dumps({"timestamp": time.time(), "value": value}))
+                    os.replace(tmp_path, path)
+                except OSError as e:
+                    print(f"Error writing cache file {path}: {e}", file=sys.stderr)
+            return value
+        return wrapper
+    return decorator
+
+def init_clients(region, max_workers):
+    """Create the AWS clients shared by all worker threads"""
+    global ec2, pricing
+    # DescribeSpotPriceHistory and the Pricing API are heavily throttled. Adaptive mode retries
+    # with jittered exponential backoff and rate-limits requests on the client side.
+    config = Config(max_pool_connections=max_workers, retries={"max_attempts": 10, "mode": "adaptive"})
+    session = boto3.session.Session(region_name=region)
+    ec2 = session.client("ec2", config=config)
+    # Pricing API is only available in us-east-1
+    pricing = session.client("pricing", region_name="us-east-1", config=config)
+
+@cached(ttl=7 * DAY)
+def prefetch_instance_details(region, instance_families):
+    """Get the InstanceTypeInfo of every instance type in the given families, keyed by instance type"""
+    paginator = ec2.get_paginator("describe_instance_types")
+    pages = paginator.paginate(
+        Filters=[{"Name": "instance-type", "Values": [f"{family}.*" for family in instance_families]}]
+    )
+    
+    details_by_type = {}
     try:
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        return json.loads(result.stdout)
-    except subprocess.CalledProcessError as e:
-        print(f"Error executing AWS command: {e}", file=sys.stderr)
-        print(f"Command output: {e.stderr}", file=sys.stderr)
-        sys.exit(1)
-    except json.JSONDecodeError as e:
-        print(f"Error parsing AWS command output: {e}", file=sys.stderr)
+        for page in pages:
+            for instance_info in page.get("InstanceTypes", []):
+                details_by_type[instance_info["InstanceType"]] = instance_info
+    except (BotoCoreError, ClientError) as e:
+        print(f"Error describing instance types: {e}", file=sys.stderr)
         sys.exit(1)
-
-def get_instance_types_for_family(region, instance_family):
-    """Get all instance types for a given family in a region"""
-    command = [
-        "aws", "ec2", "describe-instance-types",
-        "--region", region,
-        "--filters", f"Name=instance-type,Values={instance_family}.*"
-    ]
     
-    result = run_aws_command(command)
-    
-    instance_types = [instance["InstanceType"] for instance in result.get("InstanceTypes", [])]
+    return details_by_type
+
+def get_spot_price_history(instance_types, start_time, end_time):
+    """Get the spot price history of a batch of instance types"""
+    paginator = ec2.get_paginator("describe_spot_price_history")
+    pages = paginator.paginate(
+        InstanceTypes=instance_types,
+        ProductDescriptions=["Linux/UNIX", "Windows"],
+        StartTime=start_time,
+        EndTime=end_time
+    )
+    
+    history = []
+    try:
+        for page in pages:
+            history.extend(page.get("SpotPriceHistory", []))
+    except (BotoCoreError, ClientError) as e:
+        print(f"Error getting spot prices for {', '.join(instance_types)}: {e}", file=sys.stderr)
     
-    if not instance_types:
-        print(f"No instance types found for family {instance_family} in region {region}", file=sys.stderr)
+    return history
+
+def prefetch_spot_prices(region, instance_types, executor):
+    """Get spot prices for all instance types in all availability zones, keyed by instance type then AZ"""
+    # A zero-width window at the current time often returns nothing, as price points are
+    # timestamped when the price last changed. Look back an hour and keep the newest entry.
+    end_time = datetime.datetime.now(datetime.timezone.utc)
+    start_time = end_time - datetime.timedelta(hours=1)
+    
+    # Query the instance types in batches rather than once per type, with the batches in parallel
+    batches = [instance_types[i:i + SPOT_PRICE_BATCH_SIZE] for i in range(0, len(instance_types), SPOT_PRICE_BATCH_SIZE)]
+    histories = executor.map(lambda batch: get_spot_price_history(batch, start_time, end_time), batches)
+    
+    # Newest price point for each instance type, AZ and product description
+    latest = {}
+    for history in histories:
+        for price_info in history:
+            key = (price_info.get("InstanceType"), price_info.get("AvailabilityZone"), price_info.get("ProductDescription"))
+            if key not in latest or price_info["Timestamp"] > latest[key]["Timestamp"]:
+                latest[key] = price_info
+    
+    prices = defaultdict(dict)
+    for (instance_type, az, _), price_info in latest.items():
+        prices_by_az = prices[instance_type]
+        price = float(price_info.get("SpotPrice", 0))
+        
+        # Keep track of the lowest current price across product descriptions for each AZ
+        current = prices_by_az.get(az)
+        if current is None or price < current["price"]:
+            prices_by_az[az] = {
+                "price": price,
+                "available": True  # Assume available if price exists
+            }
     
-    return instance_types
+    return prices
 
-def get_instance_details(region, instance_type):
-    """Get instance type details using AWS CLI"""
-    command = [
-        "aws", "ec2", "describe-instance-types",
-        "--region", region,
-        "--instance-types", instance_type
-    ]
+def get_products(region, operating_system):
+    """Yield the parsed shared tenancy EC2 products for an operating system in the region"""
+    region_name = PRICING_LOCATIONS.get(region, region)
+    
+    paginator = pricing.get_paginator("get_products")
+    pages = paginator.paginate(
+        ServiceCode="AmazonEC2",
+        Filters=[
+            {"Type": "TERM_MATCH", "Field": "location", "Value": region_name},
+            {"Type": "TERM_MATCH", "Field": "operatingSystem", "Value": operating_system},
+            {"Type": "TERM_MATCH", "Field": "preInstalledSw", "Value": "NA"},
+            {"Type": "TERM_MATCH", "Field": "tenancy", "Value": "Shared"},
+            {"Type": "TERM_MATCH", "Field": "capacitystatus", "Value": "Used"}
+        ]
+    )
+    
+    for page in pages:
+        for product in page.get("PriceList", []):
+            try:
+                yield json_loads(product)
+            except ValueError:
+                continue
+
+@cached(ttl=1 * DAY)
+def prefetch_ondemand_prices(region):
+    """Get Linux on-demand prices for all instance types in the region, keyed by instance type"""
+    prices = {}
+    try:
+        for product_data in get_products(region, "Linux"):
+            try:
+                instance_type = product_data["product"]["attributes"]["instanceType"]
+                if instance_type in prices:
+                    continue
+                terms = product_data.get("terms", {}).get("OnDemand", {})
+                for term_info in terms.values():
+                    for price_info in term_info.get("priceDimensions", {}).values():
+                        # Keep the first price found for each instance type
+                        prices.setdefault(instance_type, float(price_info.get("pricePerUnit", {}).get("USD", 0)))
+            except (ValueError, KeyError):
+                continue
+    except (BotoCoreError, ClientError) as e:
+        print(f"Error getting on-demand pricing for region {region}: {e}", file=sys.stderr)
+        return {}
     
-    result = run_aws_command(command)
+    return prices
+
+@cached(ttl=1 * DAY)
+def prefetch_windows_instance_types(region):
+    """Get all instance types with a Windows on-demand price in the region"""
+    instance_types = set()
+    try:
+        for product_data in get_products(region, "Windows"):
+            instance_type = product_data.get("product", {}).get("attributes", {}).get("instanceType")
+            if instance_type:
+                instance_types.add(instance_type)
+    except (BotoCoreError, ClientError) as e:
+        print(f"Error getting Windows pricing for region {region}: {e}", file=sys.stderr)
+        return []
+    
+    return sorted(instance_types)
+
+def get_availability_zones(region):
+    """Get all availability zones in the region"""
+    # Not cached on disk: AZ names and visibility are mapped per AWS account
+    try:
+        result = ec2.describe_availability_zones()
+    except (BotoCoreError, ClientError) as e:
+        print(f"Error describing availability zones in region {region}: {e}", file=sys.stderr)
+        sys.exit(1)
     
-    if not result.get("InstanceTypes"):
-        print(f"Instance type {instance_type} not found in region {region}", file=sys.stderr)
-        return None
+    # A tuple so all workers can share it without copies
+    return tuple(az["ZoneName"] for az in result.get("AvailabilityZones", []))
+
+def process_instance_type(instance_type, details_by_type, spot_prices, on_demand_prices, windows_supported, all_azs):
+    """Process a single instance type and return its details"""
+    print(f"Processing instance type: {instance_type}", file=sys.stderr)
     
-    instance_info = result["InstanceTypes"][0]
+    # Get instance details from the InstanceTypeInfo fetched with the families
+    instance_info = details_by_type[instance_type]
     
     # Extract architecture
     architecture = instance_info.get("ProcessorInfo", {}).get("SupportedArchitectures", ["x86_64"])[0]
@@ -59,16 +275,10 @@ def get_instance_details(region, instance_type):
     if architecture == "x86_64":
         architecture = "amd64"
     
-    # Extract operating systems
-    operating_systems = []
-    if instance_info.get("SupportedPlatforms"):
-        operating_systems = [platform.lower() for platform in instance_info.get("SupportedPlatforms")]
-    else:
-        # Default to linux if not specified
-        operating_systems = ["linux"]
-        # Check if Windows is supported
-        if instance_info.get("HypervisorType") != "nitro" or "windows" in instance_info.get("ProcessorInfo", {}).get("SupportedArchitectures", []):
-            operating_systems.append("windows")
+    # Extract operating systems, Windows is supported if the Pricing API has a Windows price for the type
+    operating_systems = ["linux"]
+    if instance_type in windows_supported:
+        operating_systems.append("windows")
     
     # Extract resources
     vcpu_count = str(instance_info.get("VCpuInfo", {}).get("DefaultVCpus", 0))
@@ -83,152 +293,18 @@ def get_instance_details(region, instance_type):
         "pods": max_pods
     }
     
-    return {
-        "architecture": architecture,
-        "operatingSystems": operating_systems,
-        "resources": resources
-    }
-
-def get_spot_prices(region, instance_type):
-    """Get spot prices for the instance type in all availability zones"""
-    # Get current date in the required format using the non-deprecated approach
-    import datetime
-    current_time = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
-    
-    command = [
-        "aws", "ec2", "describe-spot-price-history",
-        "--region", region,
-        "--instance-types", instance_type,
-        "--product-descriptions", "Linux/UNIX", "Windows",
-        "--start-time", current_time,
-        "--end-time", current_time
-    ]
-    
-    # Use subprocess without shell=True
-    try:
-        result = subprocess.run(
-            command,
-            shell=False,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        spot_data = json.loads(result.stdout)
-    except subprocess.CalledProcessError as e:
-        print(f"Error getting spot prices for {instance_type}: {e.stderr}", file=sys.stderr)
-        return {}
-    except json.JSONDecodeError as e:
-        print(f"Error parsing spot price data for {instance_type}: {e}", file=sys.stderr)
-        return {}
-    
-    prices_by_az = defaultdict(dict)
-    for price_info in spot_data.get("SpotPriceHistory", []):
-        az = price_info.get("AvailabilityZone")
-        price = float(price_info.get("SpotPrice", 0))
-        
-        # Keep track of the lowest price for each AZ
-        if az not in prices_by_az or price < prices_by_az[az].get("price", float('inf')):
-            prices_by_az[az] = {
-                "price": price,
-                "available": True  # Assume available if price exists
-            }
-    
-    return prices_by_az
-
-def get_on_demand_price(region, instance_type):
-    """Get on-demand price for the instance type"""
-    # Map region to pricing region format
-    region_mapping = {
-        "us-east-1": "US East (N. Virginia)",
-        "us-east-2": "US East (Ohio)",
-        "us-west-1": "US West (N. California)",
-        "us-west-2": "US West (Oregon)",
-        "eu-west-1": "EU (Ireland)",
-        "eu-central-1": "EU (Frankfurt)",
-        "ap-northeast-1": "Asia Pacific (Tokyo)",
-        "ap-southeast-1": "Asia Pacific (Singapore)",
-        "ap-southeast-2": "Asia Pacific (Sydney)",
-        "ap-south-1": "Asia Pacific (Mumbai)",
-        "eu-west-2": "EU (London)",
-        "eu-west-3": "EU (Paris)",
-        "eu-north-1": "EU (Stockholm)",
-        "sa-east-1": "South America (Sao Paulo)",
-        "ca-central-1": "Canada (Central)",
-        "ap-east-1": "Asia Pacific (Hong Kong)",
-        "me-south-1": "Middle East (Bahrain)",
-        "af-south-1": "Africa (Cape Town)",
-        "eu-south-1": "EU (Milan)",
-        # Add more mappings as needed
-    }
+    # Get prefetched spot prices by AZ
+    spot_prices_by_az = spot_prices.get(instance_type, {})
     
-    region_name = region_mapping.get(region, region)
-    
-    command = [
-        "aws", "pricing", "get-products",
-        "--service-code", "AmazonEC2",
-        "--filters", 
-        f"Type=TERM_MATCH,Field=instanceType,Value={instance_type}",
-        f"Type=TERM_MATCH,Field=location,Value={region_name}",
-        f"Type=TERM_MATCH,Field=operatingSystem,Value=Linux",
-        f"Type=TERM_MATCH,Field=preInstalledSw,Value=NA",
-        f"Type=TERM_MATCH,Field=tenancy,Value=Shared",
-        f"Type=TERM_MATCH,Field=capacitystatus,Value=Used",
-        "--region", "us-east-1"  # Pricing API is only available in us-east-1
-    ]
-    
-    try:
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
-        pricing_data = json.loads(result.stdout)
-    except (subprocess.CalledProcessError, json.JSONDecodeError) as e:
-        print(f"Error getting on-demand pricing for {instance_type}: {e}", file=sys.stderr)
-        return None
-    
-    price = None
-    for product in pricing_data.get("PriceList", []):
-        try:
-            product_data = json.loads(product)
-            terms = product_data.get("terms", {}).get("OnDemand", {})
-            for term_id, term_info in terms.items():
-                for price_id, price_info in term_info.get("priceDimensions", {}).items():
-                    price = float(price_info.get("pricePerUnit", {}).get("USD", 0))
-                    return price
-        except (json.JSONDecodeError, KeyError):
-            continue
-    
-    return price
-
-def get_availability_zones(region):
-    """Get all availability zones in the region"""
-    command = [
-        "aws", "ec2", "describe-availability-zones",
-        "--region", region
-    ]
-    
-    result = run_aws_command(command)
-    
-    return [az["ZoneName"] for az in result.get("AvailabilityZones", [])]
-
-def process_instance_type(region, instance_type, all_azs):
-    """Process a single instance type and return its details"""
-    print(f"Processing instance type: {instance_type}", file=sys.stderr)
-    
-    # Get instance details
-    instance_details = get_instance_details(region, instance_type)
-    if not instance_details:
-        return None
-    
-    # Get spot prices by AZ
-    spot_prices = get_spot_prices(region, instance_type)
-    
-    # Get on-demand price
-    on_demand_price = get_on_demand_price(region, instance_type)
+    # Get prefetched on-demand price
+    on_demand_price = on_demand_prices.get(instance_type)
     
     # Build offerings array
     offerings = []
     
     # Add spot offerings for each AZ
     for az in all_azs:
-        spot_info = spot_prices.get(az, {"price": None, "available": False})
+        spot_info = spot_prices_by_az.get(az, {"price": None, "available": False})
         
         if spot_info["price"]:
             offerings.append({
@@ -248,7 +324,8 @@ def process_instance_type(region, instance_type, all_azs):
                 ]
             })
     
-    # Add on-demand offering if price is available
+    # Add on-demand offering for each AZ if price is available, Karpenter's KWOK
+    # provider expects exactly one zone per offering
     if on_demand_price:
         for az in all_azs:
             offerings.append({
@@ -272,9 +349,9 @@ def process_instance_type(region, instance_type, all_azs):
     return {
         "name": instance_type,
         "offerings": offerings,
-        "architecture": instance_details["architecture"],
-        "operatingSystems": instance_details["operatingSystems"],
-        "resources": instance_details["resources"]
+        "architecture": architecture,
+        "operatingSystems": operating_systems,
+        "resources": resources
     }
 
 def main():
@@ -282,20 +359,27 @@ def main():
     parser.add_argument("region", help="AWS region (e.g., us-west-2)")
     parser.add_argument("instance_families", nargs='+', help="AWS instance type families without sizes (e.g., g6 m5)")
     parser.add_argument("--output", "-o", default="instance_types.json", help="Output file path (default: instance_types.json)")
-    parser.add_argument("--max-workers", "-w", type=int, default=5, help="Maximum number of worker threads (default: 5)")
+    parser.add_argument("--max-workers", "-w", type=int, default=10, help="Maximum number of worker threads for background AWS API requests and processing (default: 10)")
+    parser.add_argument("--no-cache", action="store_true", help=f"Don't read or write cached API responses in {CACHE_DIR}")
     
     args = parser.parse_args()
     
-    # Get all AZs in the region
-    all_azs = get_availability_zones(args.region)
+    global cache_enabled
+    cache_enabled = not args.no_cache
+    init_clients(args.region, args.max_workers)
+    
+    # Remove any size suffix if accidentally included, then drop duplicate families
+    instance_families = list(dict.fromkeys(SIZE_SUFFIX_RE.sub('', family) for family in args.instance_families))
+    
+    # Describe all instance types for the specified families in one paginated call. This runs
+    # before any background work, so exiting on errors doesn't wait for the price sheet downloads.
+    details_by_type = prefetch_instance_details(args.region, instance_families)
+    all_instance_types = list(details_by_type)
     
-    # Collect all instance types for the specified families
-    all_instance_types = []
-    for family in args.instance_families:
-        # Remove any size suffix if accidentally included
-        family = re.sub(r'\.\d+.*$', '', family)
-        instance_types = get_instance_types_for_family(args.region, family)
-        all_instance_types.extend(instance_types)
+    # Checked outside the cached lookup so the warning is repeated on cache hits
+    for family in instance_families:
+        if not any(instance_type.startswith(f"{family}.") for instance_type in all_instance_types):
+            print(f"No instance types found for family {family} in region {args.region}", file=sys.stderr)
     
     if not all_instance_types:
         print("No instance types found for the specified families", file=sys.stderr)
@@ -303,30 +387,42 @@ def main():
     
     print(f"Found {len(all_instance_types)} instance types to process", file=sys.stderr)
     
-    # Process all instance types in parallel
-    results = []
+    output_file = args.output
     with ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+        # Start the lookups that don't depend on the instance types in the background
+        azs_future = executor.submit(get_availability_zones, args.region)
+        on_demand_prices_future = executor.submit(prefetch_ondemand_prices, args.region)
+        windows_supported_future = executor.submit(prefetch_windows_instance_types, args.region)
+        
+        # Get spot prices for all instance types up front
+        spot_prices = prefetch_spot_prices(args.region, all_instance_types, executor)
+        all_azs = azs_future.result()
+        on_demand_prices = on_demand_prices_future.result()
+        windows_supported = frozenset(windows_supported_future.result())
+        
+        # Process all instance types in parallel, streaming each result to the
+        # output file (default is instance_types.json) as it completes
         future_to_instance = {
-            executor.submit(process_instance_type, args.region, instance_type, all_azs): instance_type
+            executor.submit(process_instance_type, instance_type, details_by_type, spot_prices, on_demand_prices, windows_supported, all_azs): instance_type
             for instance_type in all_instance_types
         }
         
-        for future in as_completed(future_to_instance):
-            instance_type = future_to_instance[future]
-            try:
-                result = future.result()
-                if result:
-                    results.append(result)
-            except Exception as e:
-                print(f"Error processing {instance_type}: {e}", file=sys.stderr)
-    
-    # Format JSON output
-    formatted_output = json.dumps(results, indent=4)
-    
-    # Always write to file (default is instance_types.json)
-    output_file = args.output
-    with open(output_file, "w") as f:
-        f.write(formatted_output)
+        with open(output_file, "wb") as f:
+            f.write(b"[\n")
+            first = True
+            for future in as_completed(future_to_instance):
+                instance_type = future_to_instance[future]
+                try:
+                    result = future.result()
+                    if result:
+                        if not first:
+                            f.write(b",\n")
+                        # Indent the record as one element of the top-level array
+                        f.write(b"  " + json_dumps(result, indent=True).replace(b"\n", b"\n  "))
+                        first = False
+                except Exception as e:
+                    print(f"Error processing {instance_type}: {e}", file=sys.stderr)
+            f.write(b"\n]\n")
     print(f"Output written to {output_file}")
 
 if __name__ == "__main__":
@@ -32,6 +32,9 @@ install_on_debian() {
     # Install basic tools
     sudo apt-get install -y git build-essential
 
+    # Install boto3 for get_instance_details.py (pip --user is blocked by PEP 668 on newer releases)
+    sudo apt-get install -y python3-pip python3-boto3
+
     # Install Docker
     if ! command -v docker &> /dev/null; then
         echo "Installing Docker..."
@@ -57,6 +60,9 @@ install_on_amazon_linux() {
     # Install basic tools
     sudo yum install -y git gcc make
 
+    # Install pip for the Python dependencies of get_instance_details.py
+    sudo yum install -y python3-pip
+
     # Install Docker
     if ! command -v docker &> /dev/null; then
         echo "Installing Docker..."
@@ -80,6 +86,9 @@ install_on_centos() {
     # Install basic tools
     sudo yum install -y git gcc make
 
+    # Install pip for the Python dependencies of get_instance_details.py
+    sudo yum install -y python3-pip
+
     # Install Docker
     if ! command -v docker &> /dev/null; then
         echo "Installing Docker..."
@@ -180,6 +189,26 @@ else
     echo "AWS CLI is already installed: $(aws --version)"
 fi
 
+# Install boto3 (used by get_instance_details.py)
+echo "Installing boto3..."
+if ! python3 -c "import boto3" &> /dev/null; then
+    if python3 -m pip install --user boto3; then
+        echo "boto3 installed."
+    else
+        echo "Could not install boto3, install it manually to run get_instance_details.py."
+    fi
+else
+    echo "boto3 is already installed."
+fi
+
+# Install orjson (optional, get_instance_details.py falls back to the json module)
+echo "Installing orjson..."
+if ! python3 -c "import orjson" &> /dev/null; then
+    python3 -m pip install --user orjson || echo "Could not install orjson, the json module will be used instead."
+else
+    echo "orjson is already installed."
+fi
+
 # Install Helm
 echo "Installing Helm..."
 if ! command -v helm &> /dev/null; then